@@ -1,14 +1,15 @@
 from flask import Flask, render_template, request, redirect, session
-import os, time, base64, datetime, json, sqlite3
+import os, time, base64, datetime, json, sqlite3, threading, uuid
+import hashlib, tempfile, random, collections
 import pandas as pd
 from dotenv import load_dotenv
-from email.mime.text import MIMEText
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.events import EVENT_JOB_EXECUTED, EVENT_JOB_ERROR
 from google_auth_oauthlib.flow import Flow
 from googleapiclient.discovery import build
 from google.oauth2.credentials import Credentials
 import pytz
+import mime_builder
 
 CLIENT_CONFIG = {
     "web": {
@@ -50,6 +51,7 @@ from psycopg2.extras import RealDictCursor
 from urllib.parse import urlparse
 
 DATABASE_URL = os.environ.get("DATABASE_URL")
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "stats.db")
 
 def get_db():
     """Get database connection - works with both PostgreSQL and SQLite fallback"""
@@ -60,7 +62,7 @@ def get_db():
     else:
         # SQLite fallback (local development)
         import sqlite3
-        conn = sqlite3.connect("stats.db")
+        conn = sqlite3.connect(SQLITE_PATH)
         conn.row_factory = sqlite3.Row
         return conn
 
@@ -74,6 +76,7 @@ def init_db():
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS email_logs (
                 id SERIAL PRIMARY KEY,
+                user_email TEXT,
                 email TEXT,
                 status TEXT,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
@@ -98,11 +101,15 @@ def init_db():
                 clicked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
+        # Older databases were created before email_logs had an owner column. Rows logged
+        # before it existed keep user_email NULL and so no longer appear in anyone's stats.
+        cursor.execute("ALTER TABLE email_logs ADD COLUMN IF NOT EXISTS user_email TEXT")
     else:
         # SQLite syntax
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS email_logs (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_email TEXT,
                 email TEXT,
                 status TEXT,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
@@ -127,6 +134,18 @@ def init_db():
                 clicked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
+        # Older databases were created before email_logs had an owner column. Rows logged
+        # before it existed keep user_email NULL and so no longer appear in anyone's stats.
+        cursor.execute("PRAGMA table_info(email_logs)")
+        columns = [row[1] for row in cursor.fetchall()]
+        if "user_email" not in columns:
+            cursor.execute("ALTER TABLE email_logs ADD COLUMN user_email TEXT")
+    
+    # Tenant-scoped indexes so dashboard queries only touch the user's own rows
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_email_logs_user_status ON email_logs (user_email, status)")
+    # (user_email, created_at) was never used by a query; drop it where an earlier version created it
+    cursor.execute("DROP INDEX IF EXISTS idx_email_logs_user_created")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_email_logs_user_campaign ON email_logs (user_email, campaign_id)")
     
     db.commit()
     cursor.close()
@@ -186,109 +205,484 @@ def get_gmail_service(user_email):
     return build("gmail", "v1", credentials=creds)
 
 
-def send_bulk(user_email, recipients, subject, body, delay, sheet_data=None, attachments=None):
-    print(f"Starting send_bulk for {user_email}, {len(recipients)} recipients")
-    db = get_db()
+# ================= ATTACHMENTS =================
+# Uploads are stored once on disk under their SHA-256 and campaigns only carry
+# {"hash", "filename"} references, so identical files are shared across
+# campaigns and never held in memory for the life of a job. Each attachment is
+# encoded once (MIME base64, then Gmail's urlsafe base64) into a .raw sidecar
+# that mime_builder splices straight into messages. Encoded attachments (about
+# 1.8x the original size) are cached in memory up to ATTACHMENT_CACHE_MB in
+# total, least recently used first out, and dropped once no queued or running
+# campaign references them. A larger one is read from disk for each message.
+
+ATTACHMENT_DIR = os.environ.get("ATTACHMENT_DIR", "attachments")
+ATTACHMENT_CHUNK_SIZE = 57 * 1024  # Multiple of 3 bytes, so encoded chunks concatenate cleanly
+ATTACHMENT_CACHE_MB = float(os.environ.get("ATTACHMENT_CACHE_MB", 64))
+# Unreferenced files are kept this long, covering the gap between upload and queueing
+ATTACHMENT_TTL_HOURS = float(os.environ.get("ATTACHMENT_TTL_HOURS", 24))
+
+
+def attachment_path(file_hash):
+    return os.path.join(ATTACHMENT_DIR, file_hash)
+
+
+def store_uploads():
+    """Store the request's uploaded attachments, returning their references (or None)"""
+    return [
+        store_attachment(f) for f in request.files.getlist("attachments") if f and f.filename
+    ] or None
+
+
+def store_attachment(file):
+    """Stream an uploaded file into the attachment store and return its reference"""
+    os.makedirs(ATTACHMENT_DIR, exist_ok=True)
+    digest = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=ATTACHMENT_DIR, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            for chunk in iter(lambda: file.stream.read(ATTACHMENT_CHUNK_SIZE), b""):
+                digest.update(chunk)
+                out.write(chunk)
+        file_hash = digest.hexdigest()
+        if os.path.exists(attachment_path(file_hash)):
+            os.remove(tmp_path)  # Same content already uploaded by an earlier campaign
+            os.utime(attachment_path(file_hash))  # Fresh again as far as pruning is concerned
+        else:
+            os.replace(tmp_path, attachment_path(file_hash))
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    print(f"📎 Stored attachment {file.filename} as {file_hash[:12]}")
+    return {"hash": file_hash, "filename": file.filename}
+
+
+def encode_attachment(file_hash):
+    """Write the Gmail-ready encoding of a stored attachment next to it (once) and return its path"""
+    encoded_path = attachment_path(file_hash) + ".raw"
+    if os.path.exists(encoded_path):
+        return encoded_path
+
+    fd, tmp_path = tempfile.mkstemp(dir=ATTACHMENT_DIR, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as out, open(attachment_path(file_hash), "rb") as src:
+            for chunk in iter(lambda: src.read(ATTACHMENT_CHUNK_SIZE), b""):
+                out.write(mime_builder.encode_piece(chunk).encode("ascii"))
+        os.replace(tmp_path, encoded_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return encoded_path
+
+
+def prune_attachments():
+    """Delete stored attachments no queued, running or scheduled campaign still needs"""
+    if not os.path.isdir(ATTACHMENT_DIR):
+        return
+    in_use = set()
+    with campaign_cond:
+        for campaign in campaign_queue + list(running_campaigns.values()):
+            in_use.update(a["hash"] for a in campaign["attachments"] or ())
+    for job in scheduler.get_jobs():
+        if job.func is submit_campaign:
+            in_use.update(a["hash"] for a in job.args[6] or ())
+
+    cutoff = time.time() - ATTACHMENT_TTL_HOURS * 3600
+    removed = 0
+    for name in os.listdir(ATTACHMENT_DIR):
+        path = os.path.join(ATTACHMENT_DIR, name)
+        # Sidecars (.raw) and leftover temp files (.part) go with their blob / after the TTL
+        if name.split(".")[0] in in_use or os.path.getmtime(path) > cutoff:
+            continue
+        os.remove(path)
+        removed += 1
+    if removed:
+        print(f"🧹 Pruned {removed} attachment files")
+
+
+attachment_cache = collections.OrderedDict()  # file_hash -> encoded, least recently used first
+attachment_cache_lock = threading.Lock()
+attachment_cache_bytes = 0
+
+
+def encoded_attachment(file_hash):
+    """Gmail-ready attachment body, shared by every message that includes it"""
+    global attachment_cache_bytes
+    with attachment_cache_lock:
+        if file_hash in attachment_cache:
+            attachment_cache.move_to_end(file_hash)
+            return attachment_cache[file_hash]
+
+    with open(encode_attachment(file_hash), "rb") as f:
+        encoded = f.read().decode("ascii")
+
+    limit = ATTACHMENT_CACHE_MB * 1024 * 1024
+    if len(encoded) <= limit:
+        with attachment_cache_lock:
+            if file_hash not in attachment_cache:
+                attachment_cache[file_hash] = encoded
+                attachment_cache_bytes += len(encoded)
+                while attachment_cache_bytes > limit:
+                    _, evicted = attachment_cache.popitem(last=False)
+                    attachment_cache_bytes -= len(evicted)
+    return encoded
+
+
+def release_attachments():
+    """Drop cached attachments that no queued or running campaign references any more"""
+    global attachment_cache_bytes
+    with campaign_cond:
+        in_use = {
+            a["hash"]
+            for c in campaign_queue + list(running_campaigns.values())
+            for a in c["attachments"] or ()
+        }
+    with attachment_cache_lock:
+        for file_hash in [h for h in attachment_cache if h not in in_use]:
+            attachment_cache_bytes -= len(attachment_cache.pop(file_hash))
+
+
+# ================= DRY RUN =================
+# Dry runs go through the whole pipeline (queue, DB logging, tracking, MIME)
+# but hand messages to a fake Gmail service with configurable latency and
+# error rate, so throughput can be measured without mailing anyone. Their
+# rows are logged with status 'dry_run'/'dry_run_failed' to stay out of stats.
+
+DRY_RUN = os.environ.get("DRY_RUN") == "1"  # Force every send to be a dry run
+DRY_RUN_LATENCY_MS = float(os.environ.get("DRY_RUN_LATENCY_MS", 150))
+DRY_RUN_JITTER_MS = float(os.environ.get("DRY_RUN_JITTER_MS", 50))
+DRY_RUN_ERROR_RATE = float(os.environ.get("DRY_RUN_ERROR_RATE", 0.01))
+
+# Per-stage timings of dry-run sends (stage -> seconds). Off unless RECORD_STAGE_TIMINGS=1,
+# as benchmarks/dry_run.py sets, so dashboard dry runs don't grow it for the life of the server
+RECORD_STAGE_TIMINGS = os.environ.get("RECORD_STAGE_TIMINGS") == "1"
+stage_timings = collections.defaultdict(list)
+
+
+def record_stage(stage, started):
+    if RECORD_STAGE_TIMINGS:
+        stage_timings[stage].append(time.perf_counter() - started)
+
+
+class FakeGmailService:
+    """Stands in for the Gmail API client: users().messages().send(...).execute()"""
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def send(self, userId, body):
+        self.raw = body["raw"]
+        return self
+
+    def execute(self):
+        latency = DRY_RUN_LATENCY_MS + random.uniform(-DRY_RUN_JITTER_MS, DRY_RUN_JITTER_MS)
+        time.sleep(max(latency, 0) / 1000)
+        if random.random() < DRY_RUN_ERROR_RATE:
+            raise Exception("Simulated Gmail API error")
+        return {"id": uuid.uuid4().hex[:16], "labelIds": ["SENT"]}
+
+
+def open_campaign(campaign):
+    """Per-campaign send context, built on the campaign's first turn and kept across turns
+
+    Holds the Gmail service (whose credentials stay refreshed between turns)
+    and the message template compiled from the campaign body.
+    """
+    dry_run = campaign["dry_run"] or DRY_RUN
+    print(f"Starting campaign {campaign['id']} for {campaign['user_email']}, "
+          f"{len(campaign['recipients'])} recipients{' (dry run)' if dry_run else ''}")
+    service = FakeGmailService() if dry_run else get_gmail_service(campaign["user_email"])
+
+    # Messages are built from a template compiled once per campaign body
+    base_url = os.environ.get("APP_URL", "https://bulk-mailer-uiwh.onrender.com")
+    sheet_data = campaign["sheet_data"]
+    columns = tuple(sheet_data[0].keys()) if sheet_data else ()
+    template = mime_builder.compile_body(campaign["body"], columns, base_url)
+    return {"service": service, "template": template, "dry_run": dry_run}
+
+
+def send_one(db, campaign, i):
+    """Send the campaign's i-th message and log it. A failed send is logged, not raised."""
+    context = campaign["context"]
+    dry_run = context["dry_run"]
+    user_email = campaign["user_email"]
+    email = campaign["recipients"][i]
+    sheet_data = campaign["sheet_data"]
     cursor = db.cursor()
-    
-    # Generate unique campaign ID
-    import uuid
-    campaign_id = str(uuid.uuid4())[:8]
-    print(f"Campaign ID: {campaign_id}")
-    
     try:
-        service = get_gmail_service(user_email)
+        started = time.perf_counter()
+        # Replace template variables with data from sheet
+        personalized_subject = campaign["subject"]
+        row_data = None
+        
+        if sheet_data and i < len(sheet_data):
+            row_data = sheet_data[i]
+            # Replace all {{ column_name }} with actual values (the template fills in the body)
+            for column, value in row_data.items():
+                placeholder = "{{ " + column + " }}"
+                personalized_subject = personalized_subject.replace(placeholder, str(value))
+        if dry_run:
+            record_stage("personalize", started)
+        
+        # Insert tracking data into database first to get email_log_id
+        started = time.perf_counter()
+        query, params = db_execute(
+            "INSERT INTO email_logs (user_email, email, status, campaign_id) VALUES (?, ?, ?, ?)",
+            (user_email, email, "dry_run" if dry_run else "sent", campaign["id"])
+        )
+        cursor.execute(query, params)
+        db.commit()
+        
+        # Get the email_log_id
+        if DATABASE_URL:
+            cursor.execute("SELECT lastval()")
+            email_log_id = cursor.fetchone()[0]
+        else:
+            email_log_id = cursor.lastrowid
+        if dry_run:
+            record_stage("db_log", started)
+        
+        started = time.perf_counter()
+        raw = context["template"].raw(
+            email, personalized_subject, row_data, email_log_id,
+            [(a["filename"], encoded_attachment(a["hash"])) for a in campaign["attachments"] or ()],
+        )
+        if dry_run:
+            record_stage("build", started)
+
+        started = time.perf_counter()
+        context["service"].users().messages().send(userId="me", body={"raw": raw}).execute()
+        if dry_run:
+            record_stage("send", started)
+        print(f"✅ Sent to {email} (tracking ID: {email_log_id})")
+        
     except Exception as e:
-        print(f"ERROR: Failed to get Gmail service: {e}")
+        query, params = db_execute(
+            "INSERT INTO email_logs (user_email, email, status, campaign_id) VALUES (?, ?, ?, ?)",
+            (user_email, email, "dry_run_failed" if dry_run else "failed", campaign["id"])
+        )
+        cursor.execute(query, params)
+        db.commit()
+        print(f"❌ Failed to send to {email}: {e}")
+    finally:
+        cursor.close()
+
+# ================= CAMPAIGN QUEUE =================
+# Every send goes through this queue instead of its own thread. A fixed pool of
+# workers sends one burst at a time from whichever due campaign comes first by
+# priority class, then by the user who has been served least (weighted), so one
+# huge campaign cannot starve small ones. Campaigns are paced by a not-before
+# time rather than by sleeping, so workers (and MAX_CONCURRENT_SENDS) are only
+# held while messages are actually being sent.
+
+CAMPAIGN_PRIORITIES = {"transactional": 0, "normal": 1, "newsletter": 2}
+MAX_CONCURRENT_SENDS = int(os.environ.get("MAX_CONCURRENT_SENDS", 2))
+MAX_QUEUED_CAMPAIGNS = int(os.environ.get("MAX_QUEUED_CAMPAIGNS", 20))
+MAX_QUEUED_PER_USER = int(os.environ.get("MAX_QUEUED_PER_USER", 3))
+CAMPAIGN_BURST_SIZE = int(os.environ.get("CAMPAIGN_BURST_SIZE", 20))  # Per turn, for campaigns without a delay
+# A turn that fails outright (Gmail service or DB unavailable) is retried after
+# CAMPAIGN_RETRY_BACKOFF seconds, doubling each time; after CAMPAIGN_MAX_RETRIES
+# the campaign is aborted and its remaining recipients are logged as failed
+CAMPAIGN_MAX_RETRIES = int(os.environ.get("CAMPAIGN_MAX_RETRIES", 3))
+CAMPAIGN_RETRY_BACKOFF = float(os.environ.get("CAMPAIGN_RETRY_BACKOFF", 30))
+# Optional JSON map of user_email -> share weight, e.g. {"ops@example.com": 2}
+CAMPAIGN_USER_WEIGHTS = json.loads(os.environ.get("CAMPAIGN_USER_WEIGHTS") or "{}")
+
+campaign_cond = threading.Condition()
+campaign_queue = []      # campaigns waiting for their next burst
+running_campaigns = {}   # campaign_id -> campaign a worker is sending a burst for
+user_service = {}        # user_email -> weighted recipients dispatched (virtual time)
+campaign_seq = 0
+
+
+def active_campaign_count(user_email=None):
+    """Queued + running campaigns, optionally for one user. Caller holds campaign_cond."""
+    campaigns = campaign_queue + list(running_campaigns.values())
+    if user_email is None:
+        return len(campaigns)
+    return sum(1 for c in campaigns if c["user_email"] == user_email)
+
+
+def scheduled_campaign_count(user_email=None):
+    """Scheduled sends that have not fired yet, optionally for one user"""
+    jobs = [job for job in scheduler.get_jobs() if job.func is submit_campaign]
+    if user_email is None:
+        return len(jobs)
+    return sum(1 for job in jobs if job.args[0] == user_email)
+
+
+def campaign_admitted(user_email):
+    """Admission control over queued, running and scheduled campaigns. Caller holds campaign_cond."""
+    return (
+        active_campaign_count() + scheduled_campaign_count() < MAX_QUEUED_CAMPAIGNS
+        and active_campaign_count(user_email) + scheduled_campaign_count(user_email) < MAX_QUEUED_PER_USER
+    )
+
+
+def submit_campaign(user_email, recipients, subject, body, delay, sheet_data=None,
+                    attachments=None, priority="normal", admit_always=False, dry_run=False):
+    """Queue a campaign for the worker pool.
+
+    Returns the campaign ID, or None when admission control rejects it because
+    the queue (or this user's share of it) is full. Scheduled jobs pass
+    admit_always=True since they were counted by admission when scheduled.
+    """
+    global campaign_seq
+
+    with campaign_cond:
+        if not admit_always and not campaign_admitted(user_email):
+            print(f"⛔ Campaign from {user_email} rejected: queue full")
+            return None
+
+        # A user returning after being idle starts level with the least-served
+        # active user instead of cashing in on the time they were away
+        if active_campaign_count(user_email) == 0:
+            active_users = {c["user_email"] for c in campaign_queue + list(running_campaigns.values())}
+            floor = min((user_service.get(u, 0) for u in active_users), default=0)
+            user_service[user_email] = max(user_service.get(user_email, 0), floor)
+
+        campaign_seq += 1
+        campaign = {
+            "id": str(uuid.uuid4())[:8],
+            "seq": campaign_seq,
+            "user_email": user_email,
+            "priority": CAMPAIGN_PRIORITIES.get(priority, CAMPAIGN_PRIORITIES["normal"]),
+            "recipients": recipients,
+            "subject": subject,
+            "body": body,
+            "delay": delay,
+            "sheet_data": sheet_data,
+            "attachments": attachments,
+            "dry_run": dry_run,
+            "position": 0,
+            "retries": 0,
+            "context": None,  # Gmail service and compiled template, set on the first turn
+            "next_send_at": time.monotonic(),
+        }
+        campaign_queue.append(campaign)
+        campaign_cond.notify_all()
+
+    print(f"📥 Queued campaign {campaign['id']} for {user_email} ({len(recipients)} recipients, priority {priority})")
+    return campaign["id"]
+
+
+def next_campaign():
+    """Pop the due campaign that should get the next burst, or None. Caller holds campaign_cond."""
+    now = time.monotonic()
+    due = [c for c in campaign_queue if c["next_send_at"] <= now]
+    if not due:
+        return None
+    campaign = min(
+        due,
+        key=lambda c: (c["priority"], user_service.get(c["user_email"], 0), c["seq"]),
+    )
+    campaign_queue.remove(campaign)
+    return campaign
+
+
+def fail_remaining(campaign):
+    """Log every recipient an aborted campaign did not get to as failed"""
+    status = "dry_run_failed" if campaign["dry_run"] or DRY_RUN else "failed"
+    query, _ = db_execute(
+        "INSERT INTO email_logs (user_email, email, status, campaign_id) VALUES (?, ?, ?, ?)"
+    )
+    db = get_db()
+    cursor = db.cursor()
+    try:
+        for email in campaign["recipients"][campaign["position"]:]:
+            cursor.execute(query, (campaign["user_email"], email, status, campaign["id"]))
+        db.commit()
+    finally:
         cursor.close()
         db.close()
-        return
 
-    for i, email in enumerate(recipients):
+
+def campaign_worker():
+    # Each worker keeps one DB connection for all the turns it runs, so the
+    # pool holds at most MAX_CONCURRENT_SENDS connections; it is reopened after an error
+    db = None
+    while True:
+        with campaign_cond:
+            campaign = next_campaign()
+            while campaign is None:
+                # Sleep until the earliest campaign is due (or a new one arrives)
+                timeout = None
+                if campaign_queue:
+                    timeout = max(min(c["next_send_at"] for c in campaign_queue) - time.monotonic(), 0)
+                campaign_cond.wait(timeout)
+                campaign = next_campaign()
+            running_campaigns[campaign["id"]] = campaign
+
+        # A campaign with a delay sends one message per turn; the delay is then
+        # enforced by its next_send_at instead of a sleep holding this worker
+        start = campaign["position"]
+        end = min(start + (1 if campaign["delay"] > 0 else CAMPAIGN_BURST_SIZE), len(campaign["recipients"]))
+        ok = False
         try:
-            # Replace template variables with data from sheet
-            personalized_subject = subject
-            personalized_body = body
-            
-            if sheet_data and i < len(sheet_data):
-                row_data = sheet_data[i]
-                # Replace all {{ column_name }} with actual values
-                for column, value in row_data.items():
-                    placeholder = "{{ " + column + " }}"
-                    personalized_subject = personalized_subject.replace(placeholder, str(value))
-                    personalized_body = personalized_body.replace(placeholder, str(value))
-            
-            # Insert tracking data into database first to get email_log_id
-            query, params = db_execute(
-                "INSERT INTO email_logs (email, status, campaign_id) VALUES (?, ?, ?)",
-                (email, "sent", campaign_id)
-            )
-            cursor.execute(query, params)
-            db.commit()
-            
-            # Get the email_log_id
-            if DATABASE_URL:
-                cursor.execute("SELECT lastval()")
-                email_log_id = cursor.fetchone()[0]
-            else:
-                email_log_id = cursor.lastrowid
-            
-            # Add tracking pixel and wrap links
-            base_url = os.environ.get("APP_URL", "https://bulk-mailer-uiwh.onrender.com")
-            tracking_pixel = f'<img src="{base_url}/track/open/{email_log_id}" width="1" height="1" style="display:none" />'
-            
-            # Wrap links with click tracking
-            import re
-            def replace_link(match):
-                original_url = match.group(1)
-                tracked_url = f'{base_url}/track/click/{email_log_id}?url={original_url}'
-                return f'<a href="{tracked_url}"'
-            
-            personalized_body = re.sub(r'<a href="([^"]+)"', replace_link, personalized_body)
-            personalized_body += tracking_pixel
-            
-            # Create message with attachments if provided
-            from email.mime.multipart import MIMEMultipart
-            from email.mime.base import MIMEBase
-            from email import encoders
-            
-            if attachments:
-                message = MIMEMultipart()
-                message['to'] = email
-                message['subject'] = personalized_subject
-                message.attach(MIMEText(personalized_body, 'html'))
-                
-                # Add attachments
-                for attachment in attachments:
-                    part = MIMEBase('application', 'octet-stream')
-                    part.set_payload(attachment['data'])
-                    encoders.encode_base64(part)
-                    part.add_header('Content-Disposition', f'attachment; filename={attachment["filename"]}')
-                    message.attach(part)
-                
-                raw = base64.urlsafe_b64encode(message.as_bytes()).decode()
-            else:
-                msg = MIMEText(personalized_body, 'html')
-                msg["to"] = email
-                msg["subject"] = personalized_subject
-                raw = base64.urlsafe_b64encode(msg.as_bytes()).decode()
-
-            service.users().messages().send(userId="me", body={"raw": raw}).execute()
-            print(f"✅ Sent to {email} (tracking ID: {email_log_id})")
-            
+            if campaign["context"] is None:
+                campaign["context"] = open_campaign(campaign)
+            if db is None:
+                db = get_db()
+            for i in range(start, end):
+                send_one(db, campaign, i)
+                campaign["position"] = i + 1  # A retried turn resumes after the last recipient logged
+            ok = True
         except Exception as e:
-            query, params = db_execute(
-                "INSERT INTO email_logs (email, status, campaign_id) VALUES (?, ?, ?)",
-                (email, "failed", campaign_id)
-            )
-            cursor.execute(query, params)
-            db.commit()
-            print(f"❌ Failed to send to {email}: {e}")
-
-        time.sleep(delay)
-    
-    cursor.close()
-    db.close()
+            print(f"❌ Campaign {campaign['id']} burst failed: {e}")
+            campaign["context"] = None  # Rebuilt (credentials re-read) on the next attempt
+            if db is not None:
+                try:
+                    db.close()
+                except Exception:
+                    pass
+                db = None
+
+        aborted = False
+        with campaign_cond:
+            del running_campaigns[campaign["id"]]
+            sent = campaign["position"] - start
+            weight = CAMPAIGN_USER_WEIGHTS.get(campaign["user_email"], 1)
+            user_service[campaign["user_email"]] = user_service.get(campaign["user_email"], 0) + sent / weight
+            if ok:
+                campaign["retries"] = 0
+            else:
+                campaign["retries"] += 1
+                aborted = campaign["retries"] > CAMPAIGN_MAX_RETRIES
+            if not aborted and campaign["position"] < len(campaign["recipients"]):
+                if ok:
+                    campaign["next_send_at"] = time.monotonic() + campaign["delay"]
+                else:
+                    backoff = CAMPAIGN_RETRY_BACKOFF * 2 ** (campaign["retries"] - 1)
+                    campaign["next_send_at"] = time.monotonic() + backoff
+                    print(f"🔁 Retrying campaign {campaign['id']} in {backoff:.0f}s "
+                          f"(attempt {campaign['retries']}/{CAMPAIGN_MAX_RETRIES})")
+                campaign_queue.append(campaign)
+                campaign_cond.notify_all()
+                continue
+            campaign["context"] = None
+        if campaign["attachments"]:
+            release_attachments()
+
+        if aborted:
+            try:
+                fail_remaining(campaign)
+            except Exception as e:
+                print(f"❌ Could not log the remaining recipients of campaign {campaign['id']}: {e}")
+            print(f"🛑 Campaign {campaign['id']} aborted after {CAMPAIGN_MAX_RETRIES} retries "
+                  f"({len(campaign['recipients']) - campaign['position']} recipients not sent)")
+        else:
+            print(f"🏁 Campaign {campaign['id']} finished")
+
+
+for _ in range(MAX_CONCURRENT_SENDS):
+    threading.Thread(target=campaign_worker, daemon=True).start()
+print(f"🚀 Campaign queue started with {MAX_CONCURRENT_SENDS} workers")
+
+scheduler.add_job(prune_attachments, "interval", hours=1, id="prune_attachments", replace_existing=True)
 
 # ================= ROUTES =================
 import requests
@@ -399,6 +793,10 @@ def send():
     subject = request.form.get("subject")
     body = request.form.get("body")
     delay = int(request.form.get("delay", 2))  # Reduced default to 2 seconds
+    dry_run = request.form.get("dry_run") == "1"
+    priority = request.form.get("priority", "normal")
+    if priority not in CAMPAIGN_PRIORITIES:
+        return "❌ Invalid priority"
 
     manual = request.form.get("recipients")
     sheet = request.form.get("sheet")
@@ -432,15 +830,23 @@ def send():
     print(f"Send type: {send_type}")
 
     if send_type == "now":
-        # Run in background to avoid timeout
-        import threading
-        thread = threading.Thread(
-            target=send_bulk,
-            args=(session["user_email"], recipients, subject, body, delay, sheet_data)
+        # Check admission before storing uploads, so rejected campaigns leave nothing on disk
+        with campaign_cond:
+            admitted = campaign_admitted(session["user_email"])
+        if not admitted:
+            return "❌ Too many campaigns in progress, please try again in a few minutes", 503
+        attachments = store_uploads()
+
+        # Run in the campaign queue to avoid timeout
+        campaign_id = submit_campaign(
+            session["user_email"], recipients, subject, body, delay, sheet_data, attachments,
+            priority=priority, dry_run=dry_run,
         )
-        thread.daemon = True  # Allow thread to be killed when main process exits
-        thread.start()
-        return f"✅ Sending {len(recipients)} emails in background!"
+        if not campaign_id:
+            return "❌ Too many campaigns in progress, please try again in a few minutes", 503
+        if dry_run:
+            return f"🧪 Dry run of {len(recipients)} emails started in background! (Campaign ID: {campaign_id})"
+        return f"✅ Sending {len(recipients)} emails in background! (Campaign ID: {campaign_id})"
 
     time_str = request.form.get("time")
     # Parse the time and make it timezone-aware (IST)
@@ -455,12 +861,23 @@ def send():
     if send_time <= current_time:
         return "❌ Schedule time must be in the future!"
 
-    job = scheduler.add_job(
-        send_bulk,
-        "date",
-        run_date=send_time,
-        args=[session["user_email"], recipients, subject, body, delay, sheet_data],
-    )
+    # Scheduled sends count against the same limits as queued ones
+    with campaign_cond:
+        admitted = campaign_admitted(session["user_email"])
+    if not admitted:
+        return "❌ Too many campaigns in progress, please try again in a few minutes", 503
+    attachments = store_uploads()
+
+    with campaign_cond:
+        if not campaign_admitted(session["user_email"]):
+            return "❌ Too many campaigns in progress, please try again in a few minutes", 503
+        job = scheduler.add_job(
+            submit_campaign,
+            "date",
+            run_date=send_time,
+            args=[session["user_email"], recipients, subject, body, delay, sheet_data, attachments],
+            kwargs={"priority": priority, "admit_always": True, "dry_run": dry_run},
+        )
     
     print(f"✅ Job scheduled with ID: {job.id}, will run at {job.next_run_time}")
 
@@ -469,24 +886,42 @@ def send():
 
 @app.route("/api/stats")
 def stats_api():
+    if not session.get("logged_in"):
+        return {"error": "Not authenticated"}, 401
+    
+    user_email = session["user_email"]
     db = get_db()
     cursor = db.cursor()
 
-    cursor.execute("SELECT COUNT(*) as count FROM email_logs")
+    query, params = db_execute(
+        "SELECT COUNT(*) as count FROM email_logs WHERE user_email=? AND status IN ('sent', 'failed')",
+        (user_email,)
+    )
+    cursor.execute(query, params)
     total = cursor.fetchone()['count'] if DATABASE_URL else cursor.fetchone()[0]
     
-    cursor.execute("SELECT COUNT(*) as count FROM email_logs WHERE status='sent'")
+    query, params = db_execute(
+        "SELECT COUNT(*) as count FROM email_logs WHERE user_email=? AND status='sent'",
+        (user_email,)
+    )
+    cursor.execute(query, params)
     sent = cursor.fetchone()['count'] if DATABASE_URL else cursor.fetchone()[0]
     
-    cursor.execute("SELECT COUNT(*) as count FROM email_logs WHERE status='failed'")
+    query, params = db_execute(
+        "SELECT COUNT(*) as count FROM email_logs WHERE user_email=? AND status='failed'",
+        (user_email,)
+    )
+    cursor.execute(query, params)
     failed = cursor.fetchone()['count'] if DATABASE_URL else cursor.fetchone()[0]
 
-    cursor.execute("""
+    query, params = db_execute("""
         SELECT DATE(created_at) as date, COUNT(*) as count
         FROM email_logs
+        WHERE user_email=? AND status IN ('sent', 'failed')
         GROUP BY DATE(created_at)
         ORDER BY date
-    """)
+    """, (user_email,))
+    cursor.execute(query, params)
     daily = cursor.fetchall()
     
     cursor.close()
@@ -501,6 +936,8 @@ def stats_api():
 
 @app.route("/stats")
 def stats():
+    if not session.get("logged_in"):
+        return redirect("/")
     return render_template("stats.html")
 
 @app.route("/track/open/<int:email_log_id>")
@@ -573,31 +1010,49 @@ def get_analytics():
     db = get_db()
     cursor = db.cursor()
     
+    user_email = session["user_email"]
+    
     # Overall stats
-    cursor.execute("SELECT COUNT(*) as count FROM email_logs WHERE status='sent'")
+    query, params = db_execute(
+        "SELECT COUNT(*) as count FROM email_logs WHERE user_email=? AND status='sent'",
+        (user_email,)
+    )
+    cursor.execute(query, params)
     total_sent = cursor.fetchone()['count'] if DATABASE_URL else cursor.fetchone()[0]
     
     if DATABASE_URL:
-        cursor.execute("SELECT COUNT(*) as count FROM email_logs WHERE opened = TRUE")
+        cursor.execute(
+            "SELECT COUNT(*) as count FROM email_logs WHERE user_email = %s AND status = 'sent' AND opened = TRUE",
+            (user_email,)
+        )
         total_opened = cursor.fetchone()['count']
         
-        cursor.execute("SELECT COUNT(*) as count FROM email_logs WHERE clicked = TRUE")
+        cursor.execute(
+            "SELECT COUNT(*) as count FROM email_logs WHERE user_email = %s AND status = 'sent' AND clicked = TRUE",
+            (user_email,)
+        )
         total_clicked = cursor.fetchone()['count']
     else:
-        cursor.execute("SELECT COUNT(*) as count FROM email_logs WHERE opened = 1")
+        cursor.execute(
+            "SELECT COUNT(*) as count FROM email_logs WHERE user_email = ? AND status = 'sent' AND opened = 1",
+            (user_email,)
+        )
         total_opened = cursor.fetchone()[0]
         
-        cursor.execute("SELECT COUNT(*) as count FROM email_logs WHERE clicked = 1")
+        cursor.execute(
+            "SELECT COUNT(*) as count FROM email_logs WHERE user_email = ? AND status = 'sent' AND clicked = 1",
+            (user_email,)
+        )
         total_clicked = cursor.fetchone()[0]
     
     # Campaign breakdown
-    cursor.execute("""
+    query, params = db_execute("""
         SELECT campaign_id, 
                COUNT(*) as sent,
                SUM(CASE WHEN opened THEN 1 ELSE 0 END) as opened,
                SUM(CASE WHEN clicked THEN 1 ELSE 0 END) as clicked
         FROM email_logs
-        WHERE status='sent' AND campaign_id IS NOT NULL
+        WHERE user_email=? AND status='sent' AND campaign_id IS NOT NULL
         GROUP BY campaign_id
         ORDER BY MAX(created_at) DESC
         LIMIT 10
@@ -607,11 +1062,12 @@ def get_analytics():
                SUM(opened) as opened,
                SUM(clicked) as clicked
         FROM email_logs
-        WHERE status='sent' AND campaign_id IS NOT NULL
+        WHERE user_email=? AND status='sent' AND campaign_id IS NOT NULL
         GROUP BY campaign_id
         ORDER BY MAX(created_at) DESC
         LIMIT 10
-    """)
+    """, (user_email,))
+    cursor.execute(query, params)
     
     campaigns = [dict(row) for row in cursor.fetchall()]
     
@@ -650,7 +1106,10 @@ def get_sheet_columns():
 
 @app.route("/debug/jobs")
 def debug_jobs():
-    """Debug endpoint to see scheduled jobs"""
+    """Debug endpoint to see scheduled jobs and your own queued campaigns"""
+    if not session.get("logged_in"):
+        return "Please login first", 401
+    
     jobs = scheduler.get_jobs()
     job_info = []
     for job in jobs:
@@ -659,8 +1118,20 @@ def debug_jobs():
             "next_run": str(job.next_run_time),
             "func": job.func.__name__
         })
+    with campaign_cond:
+        campaign_info = [
+            {
+                "id": c["id"],
+                "priority": c["priority"],
+                "progress": f"{min(c['position'], len(c['recipients']))}/{len(c['recipients'])}",
+                "running": c["id"] in running_campaigns,
+            }
+            for c in list(running_campaigns.values()) + campaign_queue
+            if c["user_email"] == session["user_email"]
+        ]
     return {
         "scheduled_jobs": job_info,
+        "campaigns": campaign_info,
         "scheduler_running": scheduler.running,
         "current_time_utc": str(datetime.datetime.now(pytz.UTC)),
         "current_time_ist": str(datetime.datetime.now(IST))
@@ -0,0 +1,228 @@
+"""Dry-run load test: simulate full campaigns end to end without mailing anyone.
+
+Runs campaigns for several synthetic users through the real campaign queue,
+DB logging and MIME building, with Gmail replaced by the fake service. It then
+replays open/click tracking traffic and polls the dashboard's stats and
+analytics endpoints, and reports emails/sec, p50/p99 latencies per stage and
+DB load (queries, rows written or fetched, and time spent inside
+cursor.execute() and commit(), per phase).
+
+    python benchmarks/dry_run.py --users 5 --campaigns 4 --recipients 200
+"""
+import argparse, collections, contextlib, os, random, re, sqlite3, sys, tempfile, threading, time
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument("--users", type=int, default=5)
+parser.add_argument("--campaigns", type=int, default=4, help="campaigns per user")
+parser.add_argument("--recipients", type=int, default=200, help="recipients per campaign")
+parser.add_argument("--workers", type=int, default=4, help="MAX_CONCURRENT_SENDS")
+parser.add_argument("--latency-ms", type=float, default=150)
+parser.add_argument("--jitter-ms", type=float, default=50)
+parser.add_argument("--error-rate", type=float, default=0.01)
+parser.add_argument("--open-rate", type=float, default=0.3)
+parser.add_argument("--click-rate", type=float, default=0.05)
+parser.add_argument("--tracking-threads", type=int, default=8)
+args = parser.parse_args()
+
+# Configure the app before importing it: throwaway SQLite DB, fake Gmail settings
+db_path = os.path.join(tempfile.mkdtemp(prefix="bulk-mailer-bench-"), "bench.db")
+os.environ.pop("DATABASE_URL", None)
+os.environ.setdefault("GOOGLE_CLIENT_ID", "dry-run")
+os.environ.setdefault("GOOGLE_CLIENT_SECRET", "dry-run")
+os.environ.update({
+    "SQLITE_PATH": db_path,
+    "RECORD_STAGE_TIMINGS": "1",
+    "MAX_CONCURRENT_SENDS": str(args.workers),
+    "DRY_RUN_LATENCY_MS": str(args.latency_ms),
+    "DRY_RUN_JITTER_MS": str(args.jitter_ms),
+    "DRY_RUN_ERROR_RATE": str(args.error_rate),
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+with contextlib.redirect_stdout(open(os.devnull, "w")):
+    import app as mailer
+
+
+# ================= DB INSTRUMENTATION =================
+# Wrap the app's connections so every execute() and commit() is counted and timed
+TABLE_PATTERN = re.compile(r"\b(?:FROM|INTO|UPDATE)\s+(\w+)", re.IGNORECASE)
+db_stats = collections.defaultdict(lambda: [0, 0, 0.0])  # (phase, statement) -> [queries, rows, seconds]
+db_lock = threading.Lock()
+phase = "send"
+
+
+def record_db(statement, queries, rows, seconds):
+    with db_lock:
+        stats = db_stats[(phase, statement)]
+        stats[0] += queries
+        stats[1] += rows
+        stats[2] += seconds
+
+
+class TimedCursor:
+    """Rows are those written (rowcount) or, for reads, fetched: SQLite reports -1 for SELECTs"""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.statement = None
+
+    def execute(self, query, params=()):
+        started = time.perf_counter()
+        self.cursor.execute(query, params or ())
+        elapsed = time.perf_counter() - started
+        table = TABLE_PATTERN.search(query)
+        self.statement = query.split()[0].upper() + (" " + table.group(1) if table else "")
+        record_db(self.statement, 1, max(self.cursor.rowcount, 0), elapsed)
+        return self
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is not None:
+            record_db(self.statement, 0, 1, 0.0)
+        return row
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        record_db(self.statement, 0, len(rows), 0.0)
+        return rows
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class TimedConnection:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def cursor(self):
+        return TimedCursor(self.conn.cursor())
+
+    def commit(self):
+        started = time.perf_counter()
+        self.conn.commit()
+        record_db("COMMIT", 1, 0, time.perf_counter() - started)
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+app_get_db = mailer.get_db
+mailer.get_db = lambda: TimedConnection(app_get_db())
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def report(name, seconds):
+    print(f"  {name:<16} n={len(seconds):<7} p50={percentile(seconds, 50) * 1000:8.2f} ms"
+          f"  p99={percentile(seconds, 99) * 1000:8.2f} ms")
+
+
+BODY = "<p>Hi {{ name }},</p>" + '<p>Read <a href="https://example.com/post">the post</a>.</p>' * 20
+users = [f"loadtest{u}@dry-run.local" for u in range(args.users)]
+total = args.users * args.campaigns * args.recipients
+
+# ================= CAMPAIGNS =================
+devnull = open(os.devnull, "w")
+started = time.perf_counter()
+with contextlib.redirect_stdout(devnull):
+    for c in range(args.campaigns):
+        for user in users:
+            recipients = [f"r{c}-{i}@dry-run.local" for i in range(args.recipients)]
+            sheet_data = [{"email": r, "name": f"Reader {i}"} for i, r in enumerate(recipients)]
+            mailer.submit_campaign(
+                user, recipients, "Hello {{ name }}", BODY, 0, sheet_data,
+                priority=random.choice(list(mailer.CAMPAIGN_PRIORITIES)),
+                admit_always=True, dry_run=True,
+            )
+    while True:
+        with mailer.campaign_cond:
+            if not mailer.campaign_queue and not mailer.running_campaigns:
+                break
+        time.sleep(0.05)
+send_elapsed = time.perf_counter() - started
+
+# ================= TRACKING TRAFFIC =================
+phase = "tracking"
+conn = sqlite3.connect(db_path)
+log_ids = [row[0] for row in conn.execute("SELECT id FROM email_logs WHERE status = 'dry_run'")]
+opens = random.sample(log_ids, int(len(log_ids) * args.open_rate))
+clicks = random.sample(log_ids, int(len(log_ids) * args.click_rate))
+requests_todo = [f"/track/open/{i}" for i in opens] + [f"/track/click/{i}?url=https://example.com/post" for i in clicks]
+random.shuffle(requests_todo)
+tracking_latency = {"track_open": [], "track_click": []}
+
+
+def tracking_worker(paths):
+    client = mailer.app.test_client()
+    for path in paths:
+        t = time.perf_counter()
+        client.get(path)
+        tracking_latency["track_open" if "/open/" in path else "track_click"].append(time.perf_counter() - t)
+
+
+started = time.perf_counter()
+threads = [
+    threading.Thread(target=tracking_worker, args=(requests_todo[n::args.tracking_threads],))
+    for n in range(args.tracking_threads)
+]
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+tracking_elapsed = time.perf_counter() - started
+
+# ================= DASHBOARD POLLS =================
+# Stats and analytics leave dry-run rows out, so relabel them as real sends
+# first; otherwise the dashboard queries would match nothing
+conn.execute("UPDATE email_logs SET status = 'sent' WHERE status = 'dry_run'")
+conn.execute("UPDATE email_logs SET status = 'failed' WHERE status = 'dry_run_failed'")
+conn.commit()
+
+phase = "dashboard"
+dashboard_latency = {"api_stats": [], "api_analytics": []}
+client = mailer.app.test_client()
+for user in users:
+    with client.session_transaction(base_url="https://localhost") as sess:
+        sess["logged_in"] = True
+        sess["user_email"] = user
+    for _ in range(10):
+        for name, path in (("api_stats", "/api/stats"), ("api_analytics", "/api/analytics")):
+            t = time.perf_counter()
+            response = client.get(path, base_url="https://localhost")
+            assert response.status_code == 200, (path, response.status_code)
+            dashboard_latency[name].append(time.perf_counter() - t)
+    assert response.get_json()["total_sent"] > 0, f"dashboard sees no sends for {user}"
+
+# ================= REPORT =================
+statuses = dict(conn.execute("SELECT status, COUNT(*) FROM email_logs GROUP BY status").fetchall())
+click_rows = conn.execute("SELECT COUNT(*) FROM link_clicks").fetchone()[0]
+conn.close()
+
+print(f"Dry run: {args.users} users x {args.campaigns} campaigns x {args.recipients} recipients, "
+      f"{args.workers} workers, fake Gmail {args.latency_ms:.0f}±{args.jitter_ms:.0f} ms, "
+      f"{args.error_rate:.1%} errors")
+print(f"\nThroughput: {total / send_elapsed:.1f} emails/sec ({total} emails in {send_elapsed:.2f}s)")
+# A failed send keeps its pre-logged row and adds a failed one (relabelled above)
+failed = statuses.get("failed", 0)
+print(f"  delivered={total - failed} failed={failed}")
+print("\nSend pipeline stages:")
+for stage in ("personalize", "db_log", "build", "send"):
+    report(stage, mailer.stage_timings[stage])
+print(f"\nTracking traffic: {len(requests_todo) / tracking_elapsed:.1f} req/sec "
+      f"({len(requests_todo)} requests, {args.tracking_threads} threads)")
+report("track_open", tracking_latency["track_open"])
+report("track_click", tracking_latency["track_click"])
+print("\nDashboard:")
+report("api_stats", dashboard_latency["api_stats"])
+report("api_analytics", dashboard_latency["api_analytics"])
+print("\nDB load (time inside cursor.execute() / commit()):")
+print(f"  {'phase':<10} {'statement':<22} {'queries':>8} {'rows':>8} {'total s':>9} {'avg ms':>8}")
+for (stage, statement), (queries, rows, seconds) in sorted(db_stats.items()):
+    print(f"  {stage:<10} {statement:<22} {queries:>8} {rows:>8} {seconds:>9.3f} {seconds / queries * 1000:>8.3f}")
+print(f"  {sum(statuses.values())} email_logs rows, {click_rows} link_clicks rows, "
+      f"{os.path.getsize(db_path) / 1024:.0f} KB on disk")